@@ -1,4 +1,9 @@
+import itertools
+import math
 import tkinter
+import tkinter.font
+
+import numpy as np
 
 import http
 
@@ -20,33 +25,82 @@ class Browser:
         self.window.bind("<MouseWheel>", self.mousewheel)
         self.canvas = tkinter.Canvas(self.window, width=WIDTH, height=HEIGHT)
         self.canvas.pack()
+        self.font = tkinter.font.Font(family="Courier", size=12)
 
     def load(self, url):
         headers, body = http.request(url)
-        text = http.lex(body)
-        self.display_list = self.layout(text)
+        self.lines, self.ys = self.lex_and_layout(body)
+        self.canvas.delete("all")
+        # Canvas items are created once per line and reused while scrolling.
+        self.items = {}
+        self.visible = range(0)
+        self.canvas_scroll = self.scroll
         self.render()
 
-    def layout(self, text):
-        display_list = []
-        cursor_x, cursor_y = HSTEP, VSTEP
-        for c in text:
-            self.max_scroll = max(self.max_scroll, cursor_y)
-            display_list.append((cursor_x, cursor_y, c))
-            cursor_x += HSTEP
-            if cursor_x >= WIDTH - HSTEP or c == "\n":
-                cursor_y += VSTEP
-                cursor_x = HSTEP
-        return display_list
+    def lex_and_layout(self, body):
+        # Lay out the visible text as UTF-8 bytes; only finished lines are
+        # decoded. The fallback lexer never decodes the page as a whole, but
+        # with Lexbor lex_bytes() has to encode the text it returns.
+        text = http.lex_bytes(body)
+        data = np.frombuffer(text, dtype=np.uint8)
+        # Each glyph starts at a byte that is not a UTF-8 continuation byte.
+        glyphs = np.flatnonzero((data & 0xC0) != 0x80)
+
+        # Characters per line before the cursor wraps at WIDTH - HSTEP.
+        line_len = math.ceil((WIDTH - 2 * HSTEP) / HSTEP)
+        newline = data[glyphs] == ord("\n")
+        # A "\n" is drawn at the end of its line, so each segment runs up to
+        # and including one newline and starts on a fresh line.
+        seg = np.cumsum(newline) - newline
+        seg_start = np.concatenate(([0], np.flatnonzero(newline) + 1))
+        seg_rows = -(-np.diff(seg_start, append=len(glyphs)) // line_len)
+        seg_row = np.concatenate(([0], np.cumsum(seg_rows)[:-1]))
+        pos = np.arange(len(glyphs)) - seg_start[seg]
+        xs = HSTEP + (pos % line_len) * HSTEP
+        ys = VSTEP + (seg_row[seg] + pos // line_len) * VSTEP
+        if len(ys):
+            self.max_scroll = max(self.max_scroll, int(ys[-1]))
+
+        # Group glyphs sharing a y into one (x, y, text) line, so each line
+        # is drawn with a single create_text call.
+        starts = np.flatnonzero(np.diff(ys, prepend=-1))
+        begins = glyphs[starts]
+        ends = np.append(begins[1:], len(data))
+        lines = [
+            (x, y, text[i:j].decode("utf-8", "replace").rstrip("\n"))
+            for x, y, i, j in zip(
+                xs[starts].tolist(), ys[starts].tolist(), begins.tolist(), ends.tolist()
+            )
+        ]
+        return lines, ys[starts]
 
     def render(self):
-        self.canvas.delete("all")
-        for x, y, c in self.display_list:
-            if y > self.scroll + HEIGHT:
-                continue
-            if y + VSTEP < self.scroll:
-                continue
-            self.canvas.create_text(x, y - self.scroll, text=c)
+        # Shift everything already drawn with a single Tk call.
+        if self.canvas_scroll != self.scroll:
+            self.canvas.move("all", 0, self.canvas_scroll - self.scroll)
+            self.canvas_scroll = self.scroll
+
+        # ys never decreases, so the visible lines are one contiguous slice.
+        lo = int(np.searchsorted(self.ys, self.scroll - VSTEP, side="left"))
+        hi = int(np.searchsorted(self.ys, self.scroll + HEIGHT, side="right"))
+        old = self.visible
+        self.visible = range(lo, hi)
+
+        # Only touch lines that left or entered the viewport.
+        for i in itertools.chain(
+            range(old.start, min(old.stop, lo)), range(max(old.start, hi), old.stop)
+        ):
+            self.canvas.itemconfigure(self.items[i], state="hidden")
+        for i in itertools.chain(
+            range(lo, min(hi, old.start)), range(max(lo, old.stop), hi)
+        ):
+            if i in self.items:
+                self.canvas.itemconfigure(self.items[i], state="normal")
+            else:
+                x, y, line = self.lines[i]
+                self.items[i] = self.canvas.create_text(
+                    x, y - self.scroll, text=line, anchor="nw", font=self.font
+                )
 
     def scrolldown(self, e):
         self.scroll += SCROLL_STEP
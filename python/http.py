@@ -1,13 +1,45 @@
-import gzip
+import functools
 import socket
 import ssl
 import sys
-import zlib
 
 try:
-    import brotli
+    from isal import isal_zlib as _zlib
 except ImportError:
-    brotli = None
+    import zlib as _zlib
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+try:
+    import brotlicffi as brotli
+except ImportError:
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+# Loading the CA bundle is expensive, so share one context across requests.
+_SSL_CTX = ssl.create_default_context()
+
+_READ_SIZE = 64 * 1024
+
+# Everything but the path and host is fixed once the imports are resolved.
+_ACCEPT_ENCODING = ("br," if brotli else "") + "gzip,deflate"
+_USER_AGENT = f"Mozilla/5.0 ({sys.platform})"
+_REQUEST_TEMPLATE = (
+    "GET %b HTTP/1.1\r\n"
+    "Host: %b\r\n"
+    "Connection: keep-alive\r\n"
+    f"User-Agent: {_USER_AGENT}\r\n"
+    f"Accept-Encoding: {_ACCEPT_ENCODING}\r\n"
+    "\r\n"
+).encode()
+
+# Idle keep-alive connections, as _Readers keyed by (host, port, scheme).
+_POOL = {}
 
 
 def request(url):
@@ -19,7 +51,7 @@ def request(url):
     # Exercise data scheme
     if scheme == "data":
         content_type, body = url.split(",", 1)
-        return {"content-type": content_type}, body
+        return {"content-type": content_type}, body.encode()
 
     # 2. Parse host
     host, path = url.removeprefix("//").split("/", 1)
@@ -30,122 +62,307 @@ def request(url):
         host, port = host.split(":", 1)
         port = int(port)
 
-    # 4. Connect
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP) as sock:
-        if scheme == "https":
-            ctx = ssl.create_default_context()
-            with ctx.wrap_socket(sock, server_hostname=host) as ssock:
-                return _get_headers_and_body(ssock, host, port, path)
-        return _get_headers_and_body(sock, host, port, path)
+    # 4. Connect, reusing an idle keep-alive connection when there is one
+    key = (host, port, scheme)
+    conn = _POOL.pop(key, None)
+    response = None
+    if conn is not None:
+        try:
+            response = _get_headers_and_body(conn, host, path)
+        except OSError:
+            # The server may have closed the idle connection; reconnect.
+            conn.close()
+        except BaseException:
+            conn.close()
+            raise
+    if response is None:
+        conn = _Reader(_connect(host, port, scheme))
+        try:
+            response = _get_headers_and_body(conn, host, path)
+        except BaseException:
+            conn.close()
+            raise
+    headers, body, keep_alive = response
+    if keep_alive:
+        # A concurrent request to the same origin may have pooled its own
+        # connection meanwhile; close it rather than leak it.
+        old = _POOL.pop(key, None)
+        if old is not None:
+            old.close()
+        _POOL[key] = conn
+    else:
+        conn.close()
+
+    if "location" in headers:
+        return request(headers["location"])
 
+    # 12. Return
+    return headers, body
 
-def _get_headers_and_body(sock, host, port, path):
-    sock.connect((host, port))
-    accept_encoding = ["gzip", "deflate"]
-    if brotli:
-        accept_encoding.append("br")
-    accept_encoding = ",".join(accept_encoding)
 
+def _connect(host, port, scheme):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    try:
+        # Send the request head without waiting on Nagle's algorithm. The
+        # receive buffer is left to the kernel's autotuning.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect((host, port))
+        if scheme == "https":
+            sock = _SSL_CTX.wrap_socket(sock, server_hostname=host)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def _get_headers_and_body(response, host, path):
     # 5. Send request
-    sock.send(f"GET {path} HTTP/1.1\r\n".encode())
-    sock.send(f"Host: {host}\r\n".encode())
-    sock.send(f"Connection: close\r\n".encode())
-    sock.send(f"User-Agent: Mozilla/5.0 ({sys.platform})\r\n".encode())
-    sock.send(f"Accept-Encoding: {accept_encoding}\r\n".encode())
-    sock.send("\r\n".encode())
+    response.sock.sendall(_REQUEST_TEMPLATE % (path.encode(), host.encode()))
 
     # 6. Receive response
-    with sock.makefile("rb", newline="\r\n") as response:
-        # 7. Read status line
-        line = response.readline().decode()
-        # 8. Parse status line
-        version, status, explanation = line.split(" ", 2)
+    # Header bytes are ASCII, so latin-1 decodes the whole block without
+    # UTF-8 validation.
+    head = response.read_until(b"\r\n\r\n").decode("latin-1")
+    status_line, *header_lines = head.split("\r\n")
 
-        # 9. Check status
-        assert status in ("200", "301", "302"), f"{status}: {explanation}"
+    # 7. Parse status line
+    version, status, explanation = status_line.split(" ", 2)
 
-        # 10. Parse headers
-        headers = {}
-        while True:
-            line = response.readline().decode()
-            if line == "\r\n":
-                break
-            header, value = line.split(":", 1)
-            headers[header.lower()] = value.strip()
-
-        if "location" in headers:
-            return request(headers["location"])
-
-        if "transfer-encoding" in headers:
-            encoding = headers["transfer-encoding"]
-            if encoding == "chunked":
-                body = unchunked(response)
-            else:
-                raise RuntimeError(f"Unsupported transfer-encoding: {encoding}")
-        else:
-            body = response.read()
+    # 8. Check status
+    assert status in ("200", "301", "302"), f"{status}: {explanation}"
 
-        if "content-encoding" in headers:
-            encoding = headers["content-encoding"]
-            body = decompress(body, encoding)
+    # 9. Parse headers
+    headers = {
+        header.lower(): value.strip()
+        for header, value in (line.split(":", 1) for line in header_lines)
+    }
 
-        body = body.decode()
-        # 12. Return
-        return headers, body
+    # 10. Read body, decoding it as it arrives off the socket. The
+    # connection can only be reused if the end of the body is known.
+    keep_alive = (
+        version == "HTTP/1.1"
+        and headers.get("connection", "").lower() != "close"
+        and ("transfer-encoding" in headers or "content-length" in headers)
+    )
+    chunks = _read_body(response, headers)
+    if "content-encoding" in headers and "location" not in headers:
+        chunks = decompress(chunks, headers["content-encoding"])
+    body = b"".join(chunks)
 
+    # 11. Return
+    return headers, body, keep_alive
+
+
+class _Reader:
+    """Buffered reads from a socket through a single reusable bytearray.
+
+    One _Reader lives as long as its connection, so the buffer is reused
+    across kept-alive responses and any bytes received past the end of one
+    response are kept for the next.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = bytearray(_READ_SIZE)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0
+
+    def close(self):
+        self.sock.close()
+
+    def _fill(self):
+        # Move unread bytes to the front, growing the buffer only when full.
+        if self.start:
+            self.buf[: self.end - self.start] = self.buf[self.start : self.end]
+            self.start, self.end = 0, self.end - self.start
+        if self.end == len(self.buf):
+            self.buf = self.buf + bytearray(len(self.buf))
+            self.view = memoryview(self.buf)
+        n = self.sock.recv_into(self.view[self.end :])
+        self.end += n
+        return n
+
+    def read_until(self, sep):
+        """Return the bytes before sep and consume sep."""
+        while True:
+            i = self.buf.find(sep, self.start, self.end)
+            if i >= 0:
+                data = bytes(self.view[self.start : i])
+                self.start = i + len(sep)
+                return data
+            if not self._fill():
+                raise ConnectionError("connection closed before end of response")
+
+    def read(self, n):
+        """Return up to n bytes, or b"" once the connection is closed."""
+        if self.start == self.end and not self._fill():
+            return b""
+        data = bytes(self.view[self.start : min(self.end, self.start + n)])
+        self.start += len(data)
+        return data
 
-def unchunked(response):
-    ret = b""
 
-    def get_chunk_size():
-        chunk_size = response.readline().rstrip()
-        return int(chunk_size, 16)
+def _read_body(response, headers):
+    if "transfer-encoding" in headers:
+        encoding = headers["transfer-encoding"]
+        if encoding == "chunked":
+            yield from unchunked(response)
+        else:
+            raise RuntimeError(f"Unsupported transfer-encoding: {encoding}")
+    elif "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining:
+            chunk = response.read(min(remaining, _READ_SIZE))
+            if not chunk:
+                raise ConnectionError("connection closed before end of body")
+            remaining -= len(chunk)
+            yield chunk
+    else:
+        yield from iter(lambda: response.read(_READ_SIZE), b"")
 
+
+def unchunked(response):
     while True:
-        chunk_size = get_chunk_size()
+        chunk_size = int(response.read_until(b"\r\n"), 16)
         if chunk_size == 0:
             break
-        else:
-            ret += response.read(chunk_size)
-            response.read(2)
-    return ret
+        while chunk_size:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                raise ConnectionError("connection closed before end of body")
+            chunk_size -= len(chunk)
+            yield chunk
+        response.read_until(b"\r\n")
+    # Skip the trailer section so a reused connection starts clean.
+    while response.read_until(b"\r\n"):
+        pass
 
 
-def decompress(data, encoding):
+def decompress(chunks, encoding):
     if encoding == "gzip":
-        return gzip.decompress(data)
+        wbits = 16 + _zlib.MAX_WBITS
     elif encoding == "deflate":
-        return zlib.decompress(data, wbits=-zlib.MAX_WBITS)
+        wbits = -_zlib.MAX_WBITS
     elif encoding == "br":
         if brotli is None:
-            raise RuntimeError("please install brotli package: pip install brotli")
-        return brotli.decompress(data)
+            raise RuntimeError("please install brotli package: pip install brotlicffi")
+        decoder = brotli.Decompressor()
+        empty = True
+        for chunk in chunks:
+            empty = empty and not chunk
+            yield decoder.process(chunk)
+        if not empty and not decoder.is_finished():
+            raise EOFError("brotli stream ended before the end-of-stream marker")
+        return
     elif encoding == "identity":
-        return data
+        yield from chunks
+        return
     else:
         raise RuntimeError(f"unexpected content-encoding: {encoding}")
 
+    decoder = _zlib.decompressobj(wbits=wbits)
+    empty = True
+    for chunk in chunks:
+        empty = empty and not chunk
+        while chunk:
+            if decoder.eof:
+                # A gzip body may hold several members back to back; anything
+                # else after the end of the stream, like zero padding, is
+                # ignored as gzip.decompress does.
+                if encoding != "gzip" or not chunk.startswith(b"\x1f\x8b"):
+                    break
+                decoder = _zlib.decompressobj(wbits=wbits)
+            yield decoder.decompress(chunk)
+            chunk = decoder.unused_data
+    if not empty and not decoder.eof:
+        raise EOFError(f"{encoding} stream ended before the end-of-stream marker")
+
 
 def lex(body):
-    # TODO: Will be removed in future course.
-    def get_body(origin):
-        import re
-
-        body_re = r"<\s*body.*?>([\s\S]*)<\s*\/body\s?>"
-        m = re.search(body_re, origin, flags=re.MULTILINE)
-        if not m:
-            return origin
-        return m.group()
-
-    # TODO: This logic will be removed in future course.
-    body = get_body(body)
-    text = ""
+    if LexborHTMLParser:
+        return _lexbor_text(body)
+    return strip_tags(get_body(body)).decode("utf-8", "replace")
+
+
+def lex_bytes(body):
+    """Like lex(), but return the visible text encoded as UTF-8."""
+    if LexborHTMLParser:
+        return _lexbor_text(body).encode()
+    return strip_tags(get_body(body))
+
+
+def _lexbor_text(body):
+    # A real HTML tokenizer, so comments, entities and the contents of
+    # <script> and <style> are handled properly.
+    tree = LexborHTMLParser(body)
+    tree.strip_tags(["script", "style"])
+    # Frameset documents have no <body>; take the text of the whole tree.
+    node = tree.body if tree.body is not None else tree.root
+    return node.text(separator="") if node is not None else ""
+
+
+# TODO: Will be removed in future course.
+def get_body(origin):
+    lower = origin.lower()
+    i = lower.find(b"<body")
+    j = lower.rfind(b"</body")
+    start = lower.find(b">", i) + 1
+    if i < 0 or start == 0 or j < start:
+        return origin
+    return origin[start:j]
+
+
+# TODO: This logic will be removed in future course.
+def strip_tags(body):
+    """Return the bytes of body that lie outside tags, still undecoded."""
+    lex_core = _jit_lex_core()
+    if lex_core:
+        import numpy as np
+
+        buf = np.frombuffer(body, dtype=np.uint8)
+        out = np.empty(len(buf), dtype=np.uint8)
+        n = lex_core(buf, out)
+        return out[:n].tobytes()
+
+    text = bytearray()
+    pos = 0
+    while True:
+        i = body.find(b"<", pos)
+        if i < 0:
+            text += body[pos:]
+            break
+        text += body[pos:i]
+        j = body.find(b">", i + 1)
+        if j < 0:
+            break
+        pos = j + 1
+    return bytes(text)
+
+
+def _lex_core(buf, out):
+    # Same rules as the bytes.find loop in strip_tags(): bytes from "<"
+    # through the next ">" are dropped, and an unclosed tag drops the rest.
+    n = 0
     in_angle = False
-    for c in body:
-        if c == "<":
+    for c in buf:
+        if in_angle:
+            if c == 62:  # ">"
+                in_angle = False
+        elif c == 60:  # "<"
             in_angle = True
-        elif c == ">":
-            in_angle = False
-        elif not in_angle:
-            text += c
-    return text
+        else:
+            out[n] = c
+            n += 1
+    return n
+
+
+@functools.lru_cache(maxsize=None)
+def _jit_lex_core():
+    """Compile _lex_core with Numba on first use, or return None without it."""
+    # Importing numba takes a noticeable part of a second, so only pay for
+    # it when strip_tags() is actually reached.
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba.njit(cache=True)(_lex_core)
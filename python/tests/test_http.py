@@ -1,13 +1,28 @@
+import gc
+import gzip
+import importlib.util
+import socket
+import threading
 import unittest
+import warnings
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-from http import request, lex
+import http
+from http import decompress, request, lex
+
+
+def request_all(urls):
+    # Overlap the network round trips instead of waiting on each site in turn.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return list(executor.map(request, urls))
 
 
 class RequestTest(unittest.TestCase):
     def test_http_request(self):
         http_sites = ["http://www.google.com/", "http://example.com/"]
-        for site in http_sites:
-            headers, body = request(site)
+        for headers, body in request_all(http_sites):
             self.assertGreater(len(body), 0)
             self.assertIn("content-type", headers)
 
@@ -17,18 +32,17 @@ class RequestTest(unittest.TestCase):
             "https://www.facebook.com/",
             "https://example.com/",
         ]
-        for site in https_sites:
-            headers, body = request(site)
+        for headers, body in request_all(https_sites):
             self.assertGreater(len(body), 0)
             self.assertIn("content-type", headers)
 
     def test_data_request(self):
         headers, body = request("data:text/html,Hello world")
-        self.assertEqual(body, "Hello world")
+        self.assertEqual(body, b"Hello world")
         self.assertEqual(headers["content-type"], "text/html")
 
     def test_lex(self):
-        origin = "<body key=value> test </BODY>"
+        origin = b"<body key=value> test </BODY>"
         ret = lex(origin)
         self.assertEqual(ret, " test ")
 
@@ -37,11 +51,273 @@ class RequestTest(unittest.TestCase):
             "http://www.naver.com/",
             "http://browser.engineering/redirect",
         ]
-        for site in redirect_sites:
-            headers, body = request(site)
+        for headers, body in request_all(redirect_sites):
             self.assertGreater(len(body), 0)
             self.assertIn("content-type", headers)
 
 
+class LexTest(unittest.TestCase):
+    page = (
+        b"<html><head><title>T</title></head>"
+        b"<BODY class=x>h\xc3\xa9 <b>there</b></body></html>"
+    )
+
+    def test_fallback_extracts_body(self):
+        with mock.patch.object(http, "LexborHTMLParser", None):
+            self.assertEqual(lex(self.page), "hé there")
+            self.assertEqual(http.lex_bytes(self.page), "hé there".encode())
+            self.assertEqual(lex(b"<p>no body</p>"), "no body")
+            with mock.patch.object(http, "_jit_lex_core", lambda: None):
+                self.assertEqual(lex(self.page), "hé there")
+
+    @unittest.skipIf(http.LexborHTMLParser is None, "selectolax is not installed")
+    def test_lexbor(self):
+        page = b"<body>a<script>if (a<b) x()</script> &amp; <!-- c --><p>b</p></body>"
+        self.assertEqual(lex(page), "a & b")
+        self.assertEqual(lex(self.page), "hé there")
+        self.assertEqual(http.lex_bytes(self.page), "hé there".encode())
+
+    @unittest.skipIf(http.LexborHTMLParser is None, "selectolax is not installed")
+    def test_lexbor_without_body(self):
+        page = b"<html><frameset><frame src=a></frameset></html>"
+        self.assertEqual(lex(page), "")
+
+
+class StripTagsTest(unittest.TestCase):
+    cases = {
+        b"": b"",
+        b"plain": b"plain",
+        b"a<b>c": b"ac",
+        b"a<b": b"a",
+        b">x<y>z<": b">xz",
+        b"<p>h\xc3\xa9llo</p> <i>x</i>": b"h\xc3\xa9llo x",
+    }
+
+    def strip_without_numba(self, body):
+        with mock.patch.object(http, "_jit_lex_core", lambda: None):
+            return http.strip_tags(body)
+
+    def test_fallback(self):
+        for body, text in self.cases.items():
+            self.assertEqual(self.strip_without_numba(body), text)
+
+    @unittest.skipIf(importlib.util.find_spec("numba") is None, "numba missing")
+    def test_numba_matches_fallback(self):
+        bodies = list(self.cases) + [b"<a<b>c>d", b"x" * 1000 + b"<" + b"y" * 10]
+        for body in bodies:
+            self.assertEqual(http.strip_tags(body), self.strip_without_numba(body))
+
+
+def pieces(data, size=1000):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+class DecompressTest(unittest.TestCase):
+    page = b"".join(b"line %d\n" % i for i in range(20000))
+
+    def decode(self, data, encoding):
+        return b"".join(decompress(pieces(data), encoding))
+
+    def test_gzip(self):
+        self.assertEqual(self.decode(gzip.compress(self.page), "gzip"), self.page)
+
+    def test_gzip_multiple_members(self):
+        data = gzip.compress(b"part1 ") + gzip.compress(b"part2")
+        self.assertEqual(self.decode(data, "gzip"), b"part1 part2")
+
+    def test_gzip_trailing_zero_padding(self):
+        data = gzip.compress(b"padded") + b"\0\0\0\0"
+        self.assertEqual(self.decode(data, "gzip"), b"padded")
+
+    def test_gzip_truncated(self):
+        data = gzip.compress(self.page)
+        with self.assertRaises(EOFError):
+            self.decode(data[: len(data) // 2], "gzip")
+
+    def test_deflate(self):
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        data = compressor.compress(self.page) + compressor.flush()
+        self.assertEqual(self.decode(data, "deflate"), self.page)
+        with self.assertRaises(EOFError):
+            self.decode(data[:-10], "deflate")
+
+    @unittest.skipIf(http.brotli is None, "brotli is not installed")
+    def test_brotli(self):
+        data = http.brotli.compress(self.page)
+        self.assertEqual(self.decode(data, "br"), self.page)
+        with self.assertRaises(EOFError):
+            self.decode(data[: len(data) // 2], "br")
+
+    def test_empty_body(self):
+        self.assertEqual(self.decode(b"", "gzip"), b"")
+
+
+class ScriptedSocket:
+    """Hands out the given byte strings, one per recv_into call."""
+
+    def __init__(self, *pieces):
+        self.pieces = list(pieces)
+
+    def recv_into(self, buf):
+        if not self.pieces:
+            return 0
+        piece = self.pieces.pop(0)
+        n = min(len(buf), len(piece))
+        buf[:n] = piece[:n]
+        if n < len(piece):
+            self.pieces.insert(0, piece[n:])
+        return n
+
+
+class ReaderTest(unittest.TestCase):
+    def test_separator_split_across_receives(self):
+        reader = http._Reader(ScriptedSocket(b"head\r", b"\n\r", b"\nrest"))
+        self.assertEqual(reader.read_until(b"\r\n\r\n"), b"head")
+        self.assertEqual(reader.read(100), b"rest")
+        self.assertEqual(reader.read(100), b"")
+
+    def test_buffer_grows_for_large_headers(self):
+        head = b"X-Big: " + b"y" * (3 * http._READ_SIZE)
+        reader = http._Reader(ScriptedSocket(*pieces(head + b"\r\n\r\nbody")))
+        self.assertEqual(reader.read_until(b"\r\n\r\n"), head)
+        self.assertEqual(reader.read(100), b"body")
+
+    def test_eof_before_separator(self):
+        reader = http._Reader(ScriptedSocket(b"HTTP/1.1 200"))
+        with self.assertRaises(ConnectionError):
+            reader.read_until(b"\r\n\r\n")
+
+    def test_chunk_larger_than_buffer(self):
+        chunk = bytes(range(256)) * 1000
+        data = b"%x\r\n%b\r\n0\r\n\r\n" % (len(chunk), chunk)
+        reader = http._Reader(ScriptedSocket(*pieces(data, 7000)))
+        self.assertEqual(b"".join(http.unchunked(reader)), chunk)
+
+    def test_trailer_is_skipped_and_next_response_kept(self):
+        data = b"3\r\nabc\r\n0\r\nX-Trailer: 1\r\n\r\nHTTP/1.1 200 OK"
+        reader = http._Reader(ScriptedSocket(data))
+        self.assertEqual(list(http.unchunked(reader)), [b"abc"])
+        self.assertEqual(reader.read(100), b"HTTP/1.1 200 OK")
+
+
+def response(body, *headers, status="200 OK"):
+    head = [f"HTTP/1.1 {status}", "Content-Type: text/plain", *headers]
+    if not any(h.lower().startswith("transfer-encoding") for h in headers):
+        head.append(f"Content-Length: {len(body)}")
+    return ("\r\n".join(head) + "\r\n\r\n").encode() + body
+
+
+class LocalServer:
+    """Replays canned responses on a local port.
+
+    Each argument to start() is the list of responses for one accepted
+    connection, sent one per request; the connection is then closed.
+    """
+
+    def __init__(self):
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.sock.settimeout(5)
+        self.url = f"http://127.0.0.1:{self.sock.getsockname()[1]}/"
+        self.accepted = 0
+
+    def start(self, *connections):
+        self.thread = threading.Thread(
+            target=self.serve, args=(connections,), daemon=True
+        )
+        self.thread.start()
+
+    def serve(self, connections):
+        for responses in connections:
+            conn, _ = self.sock.accept()
+            self.accepted += 1
+            with conn:
+                for data in responses:
+                    received = b""
+                    while b"\r\n\r\n" not in received:
+                        received += conn.recv(65536)
+                    conn.sendall(data)
+
+    def close(self):
+        self.thread.join(timeout=5)
+        self.sock.close()
+
+
+class LocalRequestTest(unittest.TestCase):
+    def setUp(self):
+        for conn in http._POOL.values():
+            conn.close()
+        http._POOL.clear()
+
+    def serve(self, *connections):
+        server = LocalServer()
+        server.start(*connections)
+        self.addCleanup(server.close)
+        return server
+
+    def test_content_length_reuses_connection(self):
+        server = self.serve([response(b"hello"), response(b"world")])
+        headers, body = request(server.url)
+        self.assertEqual(body, b"hello")
+        self.assertEqual(headers["content-type"], "text/plain")
+        headers, body = request(server.url)
+        self.assertEqual(body, b"world")
+        self.assertEqual(server.accepted, 1)
+
+    def test_chunked_reuses_connection(self):
+        chunked = response(
+            b"5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n", "Transfer-Encoding: chunked"
+        )
+        server = self.serve([chunked, response(b"next")])
+        self.assertEqual(request(server.url)[1], b"hello world")
+        self.assertEqual(request(server.url)[1], b"next")
+        self.assertEqual(server.accepted, 1)
+
+    def test_reconnects_after_idle_close(self):
+        server = self.serve([response(b"first")], [response(b"second")])
+        self.assertEqual(request(server.url)[1], b"first")
+        self.assertEqual(request(server.url)[1], b"second")
+        self.assertEqual(server.accepted, 2)
+
+    def test_body_until_close_is_not_pooled(self):
+        data = b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\nuntil eof"
+        server = self.serve([data])
+        self.assertEqual(request(server.url)[1], b"until eof")
+        self.assertEqual(http._POOL, {})
+
+    def test_redirect_on_reused_connection(self):
+        server = LocalServer()
+        moved = response(b"moved", f"Location: {server.url}", status="301 Moved")
+        server.start([moved, response(b"target")])
+        self.addCleanup(server.close)
+        self.assertEqual(request(server.url)[1], b"target")
+        self.assertEqual(server.accepted, 1)
+
+    def test_error_status_closes_reused_connection(self):
+        server = self.serve([response(b"ok"), response(b"", status="404 Not Found")])
+        request(server.url)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always", ResourceWarning)
+            with self.assertRaises(AssertionError):
+                request(server.url)
+            gc.collect()
+        self.assertEqual([w for w in caught if w.category is ResourceWarning], [])
+        self.assertEqual(http._POOL, {})
+
+    def test_displaced_pool_entry_is_closed(self):
+        server = self.serve([response(b"ok")])
+        key = ("127.0.0.1", int(server.url.split(":")[2].rstrip("/")), "http")
+        other = mock.Mock()
+        connect = http._connect
+
+        def connect_while_other_finishes(*args):
+            http._POOL[key] = other
+            return connect(*args)
+
+        with mock.patch.object(http, "_connect", connect_while_other_finishes):
+            self.assertEqual(request(server.url)[1], b"ok")
+        other.close.assert_called_once_with()
+        self.assertIsNot(http._POOL[key], other)
+
+
 if __name__ == "__main__":
     unittest.main()